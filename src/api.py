@@ -1,19 +1,56 @@
 #!/usr/bin/env python3
+import asyncio
 import os
-import sys
-import json
+import orjson
+from contextlib import asynccontextmanager
 from pathlib import Path
+from anyio.to_thread import current_default_thread_limiter
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Optional, Tuple
 from dotenv import load_dotenv
 
 load_dotenv()
 
-sys.path.insert(0, str(Path(__file__).parent))
-from run_query import TextUtility
+from .run_query import TextUtility
+from .batcher import DynamicBatcher
 
-app = FastAPI(title="Multi-Task Text Utility API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Sync endpoints and blocking helpers run on the threadpool; raise the anyio
+    # default of 40 threads so they do not queue behind each other under load.
+    current_default_thread_limiter().total_tokens = int(os.getenv("THREADPOOL_SIZE", 64))
+    utility.start_metrics_writer()
+    if batcher is not None:
+        batcher.start()
+    yield
+    if batcher is not None:
+        await batcher.stop()
+    utility.stop_metrics_writer()
+    await utility.aclose()
+    utility.save_response_cache()
+
+app = FastAPI(title="Multi-Task Text Utility API", version="1.0.0", lifespan=lifespan)
+
+# Built once per process so provider clients, the prompt template and the
+# metrics file are reused across requests instead of rebuilt on every call.
+utility = TextUtility()
+
+async def _process_batch(questions: list) -> list:
+    # Same per-question path as unbatched /query: no shared concurrency cap
+    # and no 429 backoff, so a batch never waits longer than its slowest call.
+    return await asyncio.gather(*(utility.aprocess_query(q) for q in questions), return_exceptions=True)
+
+# None of the providers has a batch endpoint, so by default /query calls the
+# utility directly. BATCH_MAX_DELAY_MS > 0 groups questions arriving within
+# that window (up to BATCH_MAX_SIZE) and dispatches each group together.
+_batch_max_delay = float(os.getenv("BATCH_MAX_DELAY_MS", 0)) / 1000
+batcher = DynamicBatcher(
+    _process_batch,
+    max_batch_size=int(os.getenv("BATCH_MAX_SIZE", 8)),
+    max_delay=_batch_max_delay
+) if _batch_max_delay > 0 else None
 
 class QueryRequest(BaseModel):
     question: str = Field(..., description="User question to process")
@@ -37,7 +74,8 @@ def root():
             "/": "GET - API documentation (this endpoint)",
             "/health": "GET - Health check and available AI providers",
             "/prompts": "GET - List available prompt templates",
-            "/query": "POST - Process a user question and get structured response"
+            "/query": "POST - Process a user question and get structured response",
+            "/query/stream": "POST - Same as /query, streamed as Server-Sent Events"
         },
         "docs": "/docs"
     }
@@ -51,18 +89,23 @@ def health_check():
     - status: API health status
     - available_providers: List of initialized AI providers
     - providers_count: Number of available providers
+    - response_cache: Size and hit/miss counters of the response cache
+    - semantic_cache: Same counters for the semantic cache (null when disabled)
+    - metrics_dropped: Metrics rows dropped because the write queue was full
     """
-    utility = TextUtility()
     available_providers = [p.get('provider') for p in utility.ai_providers.values() if p]
     return {
         "status": "healthy" if available_providers else "degraded",
         "available_providers": available_providers if available_providers else None,
         "providers_count": len(available_providers),
+        "response_cache": utility.response_cache.stats(),
+        "semantic_cache": utility.semantic_cache.stats() if utility.semantic_cache else None,
+        "metrics_dropped": utility.metrics_dropped,
         "message": "API is operational" if available_providers else "No AI providers configured. Please set API keys in .env file."
     }
 
 @app.post("/query", response_model=QueryResponse)
-def process_query(request: QueryRequest):
+async def process_query(request: QueryRequest):
     """
     Process a user question and return a structured JSON response.
     
@@ -90,8 +133,10 @@ def process_query(request: QueryRequest):
     - 500: Internal server error or processing failure
     """
     try:
-        utility = TextUtility()
-        result = utility.process_query(request.question)
+        if batcher is not None:
+            result = await batcher.process_batched(request.question)
+        else:
+            result = await utility.aprocess_query(request.question)
         
         if "error" in result:
             raise HTTPException(status_code=500, detail=result.get("error", "Processing failed"))
@@ -110,6 +155,37 @@ def process_query(request: QueryRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/query/stream")
+async def stream_query(request: QueryRequest):
+    """
+    Process a user question and stream the answer as Server-Sent Events.
+    
+    The same safety checks, caching and metrics logging as /query apply.
+    
+    Events:
+    - delta: {"text": "..."} partial model output as it is generated, released line
+      by line with PII redacted. Deltas stop early if harmful content is detected.
+    - result: the final structured response, identical in shape to the /query
+      response (plus metrics.time_to_first_token_ms when the provider streamed).
+      Always the last event; the client should treat it as authoritative.
+    """
+    async def events():
+        async for event, payload in utility.astream_query(request.question):
+            data = {"text": payload} if event == "delta" else payload
+            yield f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+# (directory mtime_ns, file names); adding or removing a file bumps the mtime
+_prompts_cache: Optional[Tuple[int, list]] = None
+
+def _list_prompt_files(prompts_dir: Path) -> list:
+    global _prompts_cache
+    mtime = prompts_dir.stat().st_mtime_ns
+    if _prompts_cache is None or _prompts_cache[0] != mtime:
+        _prompts_cache = (mtime, [f.name for f in prompts_dir.glob("*.txt")])
+    return _prompts_cache[1]
+
 @app.get("/prompts")
 def list_prompts():
     """
@@ -121,19 +197,19 @@ def list_prompts():
     Returns:
     - prompts: List of available prompt template file names
     - default: The default prompt template name
-    - current: The currently active prompt template (from .env)
+    - current: The active prompt template (PROMPT_FILE as read at startup)
     """
     prompts_dir = Path("prompts")
     if not prompts_dir.exists():
         return {
             "prompts": [],
             "default": "main_prompt.txt",
-            "current": os.getenv("PROMPT_FILE", "main_prompt.txt"),
+            "current": utility.prompt_file,
             "message": "Prompts directory not found"
         }
     
-    prompt_files = [f.name for f in prompts_dir.glob("*.txt")]
-    current_prompt = os.getenv("PROMPT_FILE", "main_prompt.txt")
+    prompt_files = _list_prompt_files(prompts_dir)
+    current_prompt = utility.prompt_file
     
     return {
         "prompts": prompt_files,
@@ -145,4 +221,7 @@ def list_prompts():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WORKERS", os.cpu_count() or 2))
+    # Each worker process builds its own TextUtility, caches and batcher.
+    # loop/http "auto" pick uvloop and httptools when uvicorn[standard] is installed.
+    uvicorn.run("src.api:app", host="0.0.0.0", port=port, workers=workers, loop="auto", http="auto")
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+class DynamicBatcher:
+    def __init__(self, handler: Callable[[List[Any]], Awaitable[List[Any]]],
+                 max_batch_size: int = 8, max_delay: float = 0.0):
+        # handler receives a list of items and returns one result (or exception)
+        # per item, in order.
+        self._handler = handler
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_delay = max_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_task: Optional[asyncio.Task] = None
+        self._dispatches: Set[asyncio.Task] = set()
+
+    def start(self):
+        if self._worker_task is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._worker_task = asyncio.create_task(self._worker())
+
+    async def stop(self):
+        if self._worker_task is None:
+            return
+        self._worker_task.cancel()
+        try:
+            await self._worker_task
+        except asyncio.CancelledError:
+            pass
+        if self._dispatches:
+            await asyncio.gather(*self._dispatches, return_exceptions=True)
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Batcher stopped"))
+        self._worker_task = None
+        self._queue = None
+
+    async def process_batched(self, item: Any) -> Any:
+        if self._worker_task is None:
+            return (await self._handler([item]))[0]
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future))
+        return await future
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                # Past the deadline (immediately, with max_delay=0) only items
+                # that are already queued join the batch.
+                timeout = deadline - loop.time()
+                try:
+                    if timeout <= 0:
+                        batch.append(self._queue.get_nowait())
+                    else:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+            # Dispatch without awaiting so the next batch can be collected
+            # while this one is waiting on the provider.
+            task = asyncio.create_task(self._dispatch(batch))
+            self._dispatches.add(task)
+            task.add_done_callback(self._dispatches.discard)
+
+    async def _dispatch(self, batch: List[tuple]):
+        try:
+            results = await self._handler([item for item, _ in batch])
+        except Exception as e:
+            logger.error(f"Batch dispatch failed: {e}")
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
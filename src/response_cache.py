@@ -0,0 +1,151 @@
+import os
+import time
+import hashlib
+import tempfile
+import orjson
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+class ResponseCache:
+    def __init__(self, maxsize: int = 10000, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0
+
+    @staticmethod
+    def make_key(provider: str, model: str, question: str, template_id: str = '') -> str:
+        # Digest of the short fields only (not the formatted prompt), so the
+        # question, which may contain PII, is never held or persisted as a
+        # key. template_id identifies the prompt the question is formatted into.
+        raw = f"{provider}\x00{model}\x00{template_id}\x00{question}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any):
+        if not self.enabled:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def save(self, path) -> int:
+        # Expiry times are monotonic, so persist the remaining TTL instead.
+        now = time.monotonic()
+        entries = [[key, expires_at - now, value]
+                   for key, (expires_at, value) in self._entries.items() if expires_at > now]
+        # Written to a temporary file in the same directory and renamed into
+        # place, so workers saving concurrently never leave a torn file.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(orjson.dumps(entries))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return len(entries)
+
+    def load(self, path) -> int:
+        with open(path, 'rb') as f:
+            entries = orjson.loads(f.read())
+        now = time.monotonic()
+        for key, remaining, value in entries:
+            if remaining > 0:
+                self._entries[key] = (now + remaining, value)
+                self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+class SemanticCache:
+    def __init__(self, model_name: str = 'sentence-transformers/all-MiniLM-L6-v2',
+                 threshold: float = 0.92, maxsize: int = 10000, encoder: Any = None):
+        import numpy as np
+        if encoder is None:
+            from sentence_transformers import SentenceTransformer
+            encoder = SentenceTransformer(model_name, device='cpu')
+        self._np = np
+        self._encoder = encoder
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._matrix = None
+        self._values: list = []
+        self._last_used = np.zeros(max(maxsize, 0), dtype=np.int64)
+        self._clock = 0
+
+    def encode(self, text: str) -> Any:
+        return self._np.asarray(self._encoder.encode(text, normalize_embeddings=True), dtype=self._np.float32)
+
+    def get(self, embedding: Any) -> Optional[Any]:
+        size = len(self._values)
+        if not size:
+            self.misses += 1
+            return None
+        # Rows are unit-normalised, so the dot product is the cosine similarity.
+        scores = self._matrix[:size] @ embedding
+        best = int(scores.argmax())
+        if scores[best] < self.threshold:
+            self.misses += 1
+            return None
+        self._clock += 1
+        self._last_used[best] = self._clock
+        self.hits += 1
+        return self._values[best]
+
+    def put(self, embedding: Any, value: Any):
+        if self.maxsize <= 0:
+            return
+        if self._matrix is None:
+            self._matrix = self._np.zeros((self.maxsize, embedding.shape[0]), dtype=self._np.float32)
+        size = len(self._values)
+        if size < self.maxsize:
+            index = size
+            self._values.append(value)
+        else:
+            index = int(self._last_used.argmin())
+            self._values[index] = value
+        self._matrix[index] = embedding
+        self._clock += 1
+        self._last_used[index] = self._clock
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'size': len(self._values),
+            'maxsize': self.maxsize,
+            'threshold': self.threshold,
+            'hits': self.hits,
+            'misses': self.misses
+        }
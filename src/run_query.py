@@ -1,28 +1,171 @@
 #!/usr/bin/env python3
 import os
+import re
 import sys
-import json
+import asyncio
+import atexit
+import hashlib
+import importlib.util
+import queue
+import threading
 import time
 import csv
 import logging
-from datetime import datetime
-from typing import Dict, Any, Optional
+import orjson
+from functools import lru_cache, partial
+from string import Formatter
+from typing import Dict, Any, Optional, Tuple, AsyncIterator
 from pathlib import Path
 from dotenv import load_dotenv
 
+try:
+    from .response_cache import ResponseCache, SemanticCache
+except ImportError:
+    from response_cache import ResponseCache, SemanticCache
+
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _strip_code_fences(content: str) -> str:
+    content = content.strip()
+    if not content.startswith('```') and not content.endswith('```'):
+        return content
+    content = content.removeprefix('```json').removeprefix('```').removesuffix('```')
+    return content.strip()
+
+# The metrics writer flushes its buffered files once this many rows are
+# pending or this many seconds have passed since the last flush.
+METRICS_FLUSH_ROWS = 32
+METRICS_FLUSH_INTERVAL = 1.0
+# Longest stop_metrics_writer waits to hand over the stop marker and to join.
+METRICS_STOP_TIMEOUT = 5.0
+
+# Identical for every chat-completions request, so built once.
+_SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful assistant that responds only with valid JSON."}
+
+# (prompt, completion) USD per token
+PRICING = {
+    'openai': (1.25 / 1000000, 10.00 / 1000000),
+    'gemini': (1.25 / 1000000, 10.00 / 1000000),
+    'openrouter': (1.25 / 1000000, 10.00 / 1000000)
+}
+
+# Provider SDKs are imported on first use only: a setup that only has an
+# OpenRouter key never loads google.generativeai (grpc, protobuf), and a
+# Gemini-only setup never loads openai/httpx.
+@lru_cache(maxsize=None)
+def _load_openai_sdk():
+    import httpx
+    import openai
+    return openai, httpx
+
+@lru_cache(maxsize=None)
+def _load_gemini_sdk():
+    import google.generativeai as genai
+    return genai
+
+def _new_event_loop() -> asyncio.AbstractEventLoop:
+    # uvloop (optional, POSIX only) when available, the stdlib loop otherwise.
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.new_event_loop()
+    return uvloop.new_event_loop()
+
+def _is_rate_limited(error: Exception) -> bool:
+    # openai.RateLimitError exposes status_code, google.api_core's ResourceExhausted exposes code
+    return getattr(error, 'status_code', None) == 429 or getattr(error, 'code', None) == 429
+
+_CSV_SPECIAL = re.compile(r'[",\r\n]')
+
+def _csv_field(value: str) -> str:
+    # Same quoting csv.writer applies with QUOTE_MINIMAL.
+    if _CSV_SPECIAL.search(value):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+# (epoch second, formatted "YYYY-MM-DDTHH:MM:SS"); rows logged within the same
+# second reuse the formatted prefix.
+_timestamp_cache: Tuple[int, str] = (-1, '')
+
+def _format_timestamp(timestamp_ns: int) -> str:
+    # Local-time ISO 8601 with microseconds, like datetime.now().isoformat()
+    # but without building a datetime for every row.
+    global _timestamp_cache
+    seconds, nanos = divmod(timestamp_ns, 1_000_000_000)
+    cached_seconds, prefix = _timestamp_cache
+    if seconds != cached_seconds:
+        prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(seconds))
+        _timestamp_cache = (seconds, prefix)
+    return f"{prefix}.{nanos // 1000:06d}"
+
+def _estimate_tokens(text: str) -> int:
+    # ~3.5 characters per token, in integer arithmetic so counts stay ints
+    return max(1, (len(text) * 2) // 7)
+
+@lru_cache(maxsize=1)
+def _load_token_encoder():
+    # tiktoken is optional; cl100k_base is only an approximation for Gemini but
+    # is much closer than the character heuristic. Loaded by TextUtility.__init__.
+    try:
+        import tiktoken
+        return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        logger.info(f"tiktoken unavailable, estimating token counts from length: {e}")
+        return None
+
+def _count_tokens(text: str) -> int:
+    encoder = _load_token_encoder()
+    if encoder is None:
+        return _estimate_tokens(text)
+    return max(1, len(encoder.encode(text, disallowed_special=())))
+
 class TextUtility:
     def __init__(self):
         self.prompt_file = os.getenv('PROMPT_FILE', 'main_prompt.txt')
         self.safety_checker = self._init_safety_checker()
         self.metrics_file = Path("metrics/metrics.csv")
+        self.metrics_shard_by_provider = os.getenv('METRICS_SHARD_BY_PROVIDER', 'false').strip().lower() in ('1', 'true', 'yes')
         self.prompt_template = self._load_prompt_template()
+        self._prompt_parts = self._split_prompt_template(self.prompt_template)
+        # Short digest of the template for response cache keys, so cached
+        # answers (including persisted ones) don't outlive a prompt change.
+        self._prompt_id = hashlib.sha256(self.prompt_template.encode('utf-8')).hexdigest()[:16]
+        self._provider_priority = self._get_provider_priority()
+        # Per-request timeout in seconds (the OpenAI SDK default is 10 minutes)
+        self.provider_timeout = float(os.getenv('PROVIDER_TIMEOUT', '30'))
+        self._provider_clients: Dict[str, Dict[str, Any]] = {}
+        self._http_client = None
+        # Fallback runs on worker threads; providers (and through them the
+        # shared HTTP client) are only built while holding this lock.
+        self._provider_lock = threading.Lock()
         self.ai_providers = self._initialize_ai_providers()
         self._current_provider = self.ai_providers.get('primary') if self.ai_providers else None
+        self.response_cache = ResponseCache(
+            maxsize=int(os.getenv('RESPONSE_CACHE_SIZE', '10000')),
+            ttl=float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+        )
+        self.response_cache_file = os.getenv('RESPONSE_CACHE_FILE')
+        if self.response_cache_file and self.response_cache.enabled:
+            self._load_response_cache()
+        self.semantic_cache = self._init_semantic_cache()
+        # The first get_encoding() call may download the BPE file; do it here,
+        # before any event loop runs, rather than inside a provider call.
+        _load_token_encoder()
+        self._loop = None
+        self.max_concurrency = int(os.getenv('TEXTUTIL_MAX_CONCURRENCY', '8'))
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._semaphore_loop = None
+        self.rate_limit_max_attempts = int(os.getenv('RATE_LIMIT_MAX_ATTEMPTS', '6'))
+        self.rate_limit_base_delay = float(os.getenv('RATE_LIMIT_BASE_DELAY', '1'))
+        self.rate_limit_max_wait = float(os.getenv('RATE_LIMIT_MAX_WAIT', '15'))
+        self._metrics_queue: Optional[queue.Queue] = None
+        self.metrics_queue_size = int(os.getenv('METRICS_QUEUE_SIZE', '10000'))
+        self.metrics_dropped = 0
+        self._metrics_thread: Optional[threading.Thread] = None
+        self._metrics_lock = threading.Lock()
         
         self.metrics_file.parent.mkdir(exist_ok=True)
         if not self.metrics_file.exists():
@@ -30,13 +173,52 @@ class TextUtility:
     
     def _init_safety_checker(self):
         try:
-            sys.path.insert(0, str(Path(__file__).parent))
-            from safety import SafetyChecker
+            try:
+                from .safety import SafetyChecker
+            except ImportError:
+                from safety import SafetyChecker
             return SafetyChecker()
         except ImportError:
             logger.warning("Safety module not found, using basic safety checks")
             return None
     
+    def _init_semantic_cache(self) -> Optional[SemanticCache]:
+        if os.getenv('SEMANTIC_CACHE', 'false').strip().lower() not in ('1', 'true', 'yes'):
+            return None
+        maxsize = int(os.getenv('SEMANTIC_CACHE_SIZE', '10000'))
+        if maxsize <= 0:
+            return None
+        try:
+            cache = SemanticCache(
+                model_name=os.getenv('SEMANTIC_CACHE_MODEL', 'sentence-transformers/all-MiniLM-L6-v2'),
+                threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.92')),
+                maxsize=maxsize
+            )
+            logger.info(f"Semantic cache enabled (threshold: {cache.threshold})")
+            return cache
+        except ImportError:
+            logger.warning("sentence-transformers/numpy not installed, semantic cache disabled")
+            return None
+    
+    def _load_response_cache(self):
+        try:
+            count = self.response_cache.load(self.response_cache_file)
+            logger.info(f"Loaded {count} cached responses from {self.response_cache_file}")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load response cache: {e}")
+    
+    def save_response_cache(self):
+        if not self.response_cache_file or not self.response_cache.enabled:
+            return
+        try:
+            Path(self.response_cache_file).parent.mkdir(parents=True, exist_ok=True)
+            count = self.response_cache.save(self.response_cache_file)
+            logger.info(f"Saved {count} cached responses to {self.response_cache_file}")
+        except OSError as e:
+            logger.warning(f"Could not save response cache: {e}")
+    
     def _load_prompt_template(self) -> str:
         prompt_path = Path(f"prompts/{self.prompt_file}")
         if prompt_path.exists():
@@ -45,6 +227,32 @@ class TextUtility:
             logger.warning(f"Prompt file {self.prompt_file} not found, using default")
         return self._get_default_prompt()
     
+    def _split_prompt_template(self, template: str) -> Optional[Tuple[str, str]]:
+        # Pre-split the template around its single {question} field so each
+        # request is a plain concatenation instead of a full str.format pass.
+        # Templates with any other fields keep using str.format.
+        try:
+            parsed = list(Formatter().parse(template))
+        except ValueError:
+            return None
+        fields = [(field, spec, conversion) for _, field, spec, conversion in parsed if field is not None]
+        if fields != [('question', '', None)]:
+            return None
+        prefix, suffix = [], []
+        target = prefix
+        for literal, field, _, _ in parsed:
+            target.append(literal)
+            if field is not None:
+                target = suffix
+        return ''.join(prefix), ''.join(suffix)
+    
+    def _format_prompt(self, question: str) -> str:
+        if self._prompt_parts:
+            # One allocation; a + b + c would copy the (long) prefix twice.
+            prefix, suffix = self._prompt_parts
+            return ''.join((prefix, question, suffix))
+        return self.prompt_template.format(question=question)
+    
     def _get_default_prompt(self) -> str:
         return """<RULES>
 You are a helpful customer support assistant. Follow these rules:
@@ -68,8 +276,8 @@ Response Format:
 {question}
 </USER>"""
 
-    def _init_metrics_file(self):
-        with open(self.metrics_file, 'w', newline='') as f:
+    def _init_metrics_file(self, path: Optional[Path] = None):
+        with open(path or self.metrics_file, 'w', newline='') as f:
             writer = csv.writer(f)
             writer.writerow([
                 'timestamp', 'question', 'provider', 'model', 'tokens_prompt', 'tokens_completion', 
@@ -77,20 +285,38 @@ Response Format:
                 'question_hash', 'output_hash'
             ])
     
+    def _get_provider(self, provider_name: str) -> Optional[Dict[str, Any]]:
+        # Clients are built on first use and kept, so switching back and forth
+        # between providers on fallback reuses their connection pools.
+        provider = self._provider_clients.get(provider_name)
+        if provider is None:
+            with self._provider_lock:
+                provider = self._provider_clients.get(provider_name)
+                if provider is None:
+                    provider = self._initialize_single_provider(provider_name)
+                    if provider:
+                        self._provider_clients[provider_name] = provider
+        return provider
+    
     def _initialize_single_provider(self, provider_name: str) -> Optional[Any]:
         if provider_name == "openrouter":
             openrouter_key = os.getenv('OPENROUTER_API_KEY')
             if not openrouter_key:
                 return None
             try:
-                from openai import OpenAI as OpenRouterClient
-                client = OpenRouterClient(
+                openai, _ = _load_openai_sdk()
+                client = openai.AsyncOpenAI(
                     api_key=openrouter_key,
-                    base_url="https://openrouter.ai/api/v1"
+                    base_url="https://openrouter.ai/api/v1",
+                    http_client=self._make_http_client(),
+                    timeout=self.provider_timeout,
+                    # 429s are retried by _call_ai_provider; SDK retries would stack on top
+                    max_retries=0
                 )
                 model = os.getenv('OPENROUTER_MODEL', 'openai/gpt-3.5-turbo')
+                temperature = float(os.getenv('OPENROUTER_TEMPERATURE', '0.3'))
                 logger.info(f"OpenRouter initialized with model: {model}")
-                return {'client': client, 'provider': 'openrouter', 'model': model}
+                return {'client': client, 'provider': 'openrouter', 'model': model, 'temperature': temperature}
             except Exception as e:
                 logger.warning(f"Failed to initialize OpenRouter: {e}")
                 return None
@@ -100,12 +326,13 @@ Response Format:
             if not gemini_key:
                 return None
             try:
-                import google.generativeai as genai
+                genai = _load_gemini_sdk()
                 genai.configure(api_key=gemini_key)
                 model_name = os.getenv('GEMINI_MODEL', 'gemini-2.5-flash')
+                temperature = float(os.getenv('GEMINI_TEMPERATURE', '0.3'))
                 client = genai.GenerativeModel(model_name)
                 logger.info(f"Gemini initialized with model: {model_name}")
-                return {'client': client, 'provider': 'gemini', 'model': model_name}
+                return {'client': client, 'provider': 'gemini', 'model': model_name, 'temperature': temperature}
             except Exception as e:
                 logger.warning(f"Failed to initialize Gemini: {e}")
                 return None
@@ -115,17 +342,36 @@ Response Format:
             if not openai_key:
                 return None
             try:
-                from openai import OpenAI
-                client = OpenAI(api_key=openai_key)
+                openai, _ = _load_openai_sdk()
+                client = openai.AsyncOpenAI(api_key=openai_key, http_client=self._make_http_client(),
+                                            timeout=self.provider_timeout, max_retries=0)
                 model_name = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+                temperature = float(os.getenv('OPENAI_TEMPERATURE', '0.3'))
                 logger.info(f"OpenAI initialized with model: {model_name}")
-                return {'client': client, 'provider': 'openai', 'model': model_name}
+                return {'client': client, 'provider': 'openai', 'model': model_name, 'temperature': temperature}
             except Exception as e:
                 logger.warning(f"Failed to initialize OpenAI: {e}")
                 return None
         
         return None
     
+    def _make_http_client(self) -> Any:
+        # One connection pool shared by every OpenAI-SDK client (OpenAI and
+        # OpenRouter), so fallback between them starts with warm connections.
+        # HTTP/2 is used when the optional h2 package is installed.
+        if self._http_client is None:
+            openai, httpx = _load_openai_sdk()
+            self._http_client = openai.DefaultAsyncHttpxClient(
+                http2=importlib.util.find_spec('h2') is not None,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+            )
+        return self._http_client
+    
+    async def aclose(self):
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+    
     def _get_provider_priority(self) -> list:
         priority_str = os.getenv('PROVIDER_PRIORITY', '').strip()
         if priority_str:
@@ -143,10 +389,8 @@ Response Format:
         return default_priority
     
     def _initialize_ai_providers(self) -> Dict[str, Any]:
-        provider_priority = self._get_provider_priority()
-        
-        for provider_name in provider_priority:
-            result = self._initialize_single_provider(provider_name)
+        for provider_name in self._provider_priority:
+            result = self._get_provider(provider_name)
             if result:
                 return {'primary': result}
         
@@ -154,58 +398,170 @@ Response Format:
         return {}
     
     def _calculate_cost(self, provider: str, prompt_tokens: int, completion_tokens: int) -> float:
-        pricing = {
-            'openai': {
-                'prompt': 1.25 / 1000000,
-                'completion': 10.00 / 1000000
-            },
-            'gemini': {
-                'prompt': 1.25 / 1000000,
-                'completion': 10.00 / 1000000
-            },
-            'openrouter': {
-                'prompt': 1.25 / 1000000,
-                'completion': 10.00 / 1000000
-            }
-        }
-        
-        p = pricing.get(provider, pricing['openrouter'])
-        prompt_cost = prompt_tokens * p['prompt']
-        completion_cost = completion_tokens * p['completion']
-        
-        return prompt_cost + completion_cost
+        prompt_rate, completion_rate = PRICING.get(provider, PRICING['openrouter'])
+        return prompt_tokens * prompt_rate + completion_tokens * completion_rate
     
     def _log_metrics(self, question: str, provider: str, prompt_tokens: int, 
                     completion_tokens: int, latency_ms: float, safety_passed: bool, 
-                    model: str = None, output_text: str = None):
+                    model: str = None, output_text: str = None, estimated_cost: float = None,
+                    output_redacted: bool = False):
+        # output_redacted marks output_text as already passed through redact_pii
+        # (mask_output did it), so the writer hashes it without redacting again.
+        # Only enqueues; hashing, PII redaction, formatting and file I/O all
+        # happen on the metrics writer thread.
+        if self._metrics_thread is None:
+            self.start_metrics_writer()
+        try:
+            self._metrics_queue.put_nowait((time.time_ns(), question, provider, prompt_tokens, completion_tokens,
+                                            latency_ms, safety_passed, model, output_text, estimated_cost,
+                                            output_redacted))
+        except queue.Full:
+            # The disk can't keep up; drop the row rather than block the request.
+            self.metrics_dropped += 1
+            if self.metrics_dropped == 1 or self.metrics_dropped % 1000 == 0:
+                logger.warning(f"Metrics queue full, {self.metrics_dropped} rows dropped so far")
+    
+    def _format_metrics_row(self, timestamp_ns: int, question: str, provider: str, prompt_tokens: int,
+                            completion_tokens: int, latency_ms: float, safety_passed: bool,
+                            model: Optional[str], output_text: Optional[str],
+                            estimated_cost: Optional[float], output_redacted: bool = False) -> str:
         total_tokens = prompt_tokens + completion_tokens
-        estimated_cost = self._calculate_cost(provider, prompt_tokens, completion_tokens)
+        if estimated_cost is None:
+            estimated_cost = self._calculate_cost(provider, prompt_tokens, completion_tokens)
         
         if self.safety_checker:
-            question_hash = self.safety_checker.hash_content(question)
-            output_hash = self.safety_checker.hash_content(output_text) if output_text else ''
-            sanitized_question = self.safety_checker.redact_pii(question[:100])
+            # One redaction pass serves both the hash and the logged text when
+            # the whole question fits in the 100-character column.
+            redacted_question = self.safety_checker.redact_pii(question)
+            question_hash = self.safety_checker.hash_redacted(redacted_question)
+            if len(question) <= 100:
+                sanitized_question = redacted_question
+            else:
+                sanitized_question = self.safety_checker.redact_pii(question[:100])
+            if not output_text:
+                output_hash = ''
+            elif output_redacted:
+                output_hash = self.safety_checker.hash_redacted(output_text)
+            else:
+                output_hash = self.safety_checker.hash_content(output_text)
         else:
             question_hash = ''
             output_hash = ''
             sanitized_question = question[:100]
         
-        with open(self.metrics_file, 'a', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                datetime.now().isoformat(),
-                sanitized_question,
-                provider,
-                model or 'unknown',
-                prompt_tokens,
-                completion_tokens,
-                total_tokens,
-                round(latency_ms, 2),
-                round(estimated_cost, 6),
-                safety_passed,
-                question_hash,
-                output_hash
-            ])
+        # Only the free-text fields can need CSV quoting; everything else is
+        # numeric, boolean, hex or a provider name and is written as-is.
+        return (
+            f"{_format_timestamp(timestamp_ns)},{_csv_field(sanitized_question)},{provider},"
+            f"{_csv_field(model or 'unknown')},{prompt_tokens},{completion_tokens},{total_tokens},"
+            f"{round(latency_ms, 2)},{round(estimated_cost, 6)},{safety_passed},"
+            f"{question_hash},{output_hash}\r\n"
+        )
+    
+    def start_metrics_writer(self, batch_size: int = 64, max_delay: float = 0.2):
+        # Started on first use if not called explicitly; stop_metrics_writer is
+        # registered with atexit so queued rows are written before exit.
+        with self._metrics_lock:
+            if self._metrics_thread is not None:
+                return
+            self._metrics_queue = queue.Queue(maxsize=self.metrics_queue_size)
+            self._metrics_thread = threading.Thread(
+                target=self._metrics_writer, args=(self._metrics_queue, batch_size, max_delay),
+                name='metrics-writer', daemon=True
+            )
+            self._metrics_thread.start()
+        atexit.register(self.stop_metrics_writer)
+    
+    def stop_metrics_writer(self):
+        with self._metrics_lock:
+            thread = self._metrics_thread
+            if thread is None:
+                return
+            self._metrics_thread = None
+            rows = self._metrics_queue
+        # Bounded so a dead or stuck writer cannot hang shutdown (this also runs from atexit).
+        if thread.is_alive():
+            try:
+                rows.put(None, timeout=METRICS_STOP_TIMEOUT)
+            except queue.Full:
+                logger.error("Metrics writer is not draining its queue; queued rows are lost")
+            thread.join(METRICS_STOP_TIMEOUT)
+        atexit.unregister(self.stop_metrics_writer)
+    
+    def _metrics_writer(self, rows: "queue.Queue", batch_size: int, max_delay: float):
+        # One buffered handle per output file for the writer's lifetime. Batches
+        # go into the 64 KiB buffers; handles are flushed once METRICS_FLUSH_ROWS
+        # rows are pending, METRICS_FLUSH_INTERVAL has passed, or the queue is idle.
+        handles: Dict[Path, Any] = {}
+        pending = 0
+        flushed_at = time.monotonic()
+        
+        def flush():
+            # Reset first so a failing flush is retried on the next write or
+            # idle interval rather than immediately.
+            nonlocal pending, flushed_at
+            pending = 0
+            flushed_at = time.monotonic()
+            for fh in handles.values():
+                fh.flush()
+        
+        try:
+            stopping = False
+            while not stopping:
+                try:
+                    item = rows.get(timeout=METRICS_FLUSH_INTERVAL if pending else None)
+                except queue.Empty:
+                    try:
+                        flush()
+                    except OSError as e:
+                        logger.error(f"Failed to write metrics: {e}")
+                    continue
+                if item is None:
+                    break
+                batch = [item]
+                while len(batch) < batch_size:
+                    try:
+                        item = rows.get(timeout=max_delay)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                try:
+                    grouped: Dict[Path, list] = {}
+                    for row in batch:
+                        grouped.setdefault(self._metrics_path(row[2]), []).append(self._format_metrics_row(*row))
+                    for path, lines in grouped.items():
+                        fh = handles.get(path)
+                        if fh is None:
+                            fh = handles[path] = self._open_metrics_file(path)
+                        fh.write(''.join(lines).encode('utf-8'))
+                    pending += len(batch)
+                    if pending >= METRICS_FLUSH_ROWS or time.monotonic() - flushed_at >= METRICS_FLUSH_INTERVAL:
+                        flush()
+                except Exception as e:
+                    logger.error(f"Failed to write metrics: {e}")
+        finally:
+            for fh in handles.values():
+                try:
+                    fh.close()
+                except OSError as e:
+                    logger.error(f"Failed to write metrics: {e}")
+    
+    def _metrics_path(self, provider: str) -> Path:
+        # With METRICS_SHARD_BY_PROVIDER each provider gets its own file next
+        # to metrics.csv (metrics/openai.csv, ...), same columns.
+        if self.metrics_shard_by_provider:
+            return self.metrics_file.with_name(f"{provider}.csv")
+        return self.metrics_file
+    
+    def _open_metrics_file(self, path: Path):
+        if not path.exists():
+            self._init_metrics_file(path)
+        # Binary append: each batch is encoded to UTF-8 once, independent of
+        # the locale's default encoding, and skips the text-layer wrapper.
+        return open(path, 'ab', buffering=65536)
     
     def _safety_check(self, question: str) -> Dict[str, Any]:
         if self.safety_checker:
@@ -218,60 +574,175 @@ Response Format:
             return {'safe': True, 'reason': 'Passed basic checks'}
     
     def _get_current_provider(self) -> Optional[Dict[str, Any]]:
-        if self._current_provider:
-            return self._current_provider
-        return None
+        # Resolved once at startup and only changed by fallback.
+        return self._current_provider
     
     def _try_fallback_provider(self) -> Optional[Dict[str, Any]]:
-        provider_priority = self._get_provider_priority()
         current_provider_name = self._current_provider.get('provider') if self._current_provider else None
         
-        for provider_name in provider_priority:
+        for provider_name in self._provider_priority:
             if provider_name == current_provider_name:
                 continue
-            result = self._initialize_single_provider(provider_name)
+            result = self._get_provider(provider_name)
             if result:
                 logger.info(f"Fallback to {provider_name} provider")
                 self._current_provider = result
                 return result
         return None
     
-    def _call_ai_provider(self, provider_info: Dict[str, Any], formatted_prompt: str) -> Dict[str, Any]:
+    def _bind_provider_call(self, provider_info: Dict[str, Any]) -> Optional[Any]:
+        # Resolves the provider-specific call once, with client, model and
+        # temperature bound, and keeps it on the provider dict.
         provider_name = provider_info.get('provider')
         client = provider_info.get('client')
         model = provider_info.get('model')
+        temperature = provider_info.get('temperature', 0.3)
         
-        try:
-            if provider_name == "openai":
-                return self._call_openai(client, model, formatted_prompt)
-            elif provider_name == "gemini":
-                return self._call_gemini(client, formatted_prompt)
-            elif provider_name == "openrouter":
-                return self._call_openrouter(client, model, formatted_prompt)
-            else:
-                return {
-                    'success': False,
-                    'error': f'Unknown provider: {provider_name}',
-                    'content': None,
-                    'tokens_prompt': 0,
-                    'tokens_completion': 0
-                }
-        except Exception as e:
-            logger.error(f"Error calling {provider_name}: {e}")
+        if provider_name == "openai":
+            call = partial(self._call_openai, client, model, temperature=temperature)
+        elif provider_name == "gemini":
+            call = partial(self._call_gemini, client, temperature=temperature)
+        elif provider_name == "openrouter":
+            call = partial(self._call_openrouter, client, model, temperature=temperature)
+        else:
+            return None
+        provider_info['call'] = call
+        return call
+    
+    async def _call_ai_provider(self, provider_info: Dict[str, Any], formatted_prompt: str,
+                                retry_rate_limits: bool = False) -> Dict[str, Any]:
+        # A 429 is retried with exponential backoff only when retry_rate_limits is
+        # set (batch callers), and only while the total wait stays within
+        # RATE_LIMIT_MAX_WAIT; otherwise it fails at once so fallback can run.
+        provider_name = provider_info.get('provider')
+        call = provider_info.get('call') or self._bind_provider_call(provider_info)
+        if call is None:
             return {
                 'success': False,
-                'error': str(e),
+                'error': f'Unknown provider: {provider_name}',
                 'content': None,
                 'tokens_prompt': 0,
                 'tokens_completion': 0
             }
+        
+        attempt = 0
+        waited = 0.0
+        while True:
+            try:
+                return await call(formatted_prompt)
+            except Exception as e:
+                attempt += 1
+                delay = self.rate_limit_base_delay * 2 ** (attempt - 1)
+                if (retry_rate_limits and _is_rate_limited(e) and attempt < self.rate_limit_max_attempts
+                        and waited + delay <= self.rate_limit_max_wait):
+                    logger.warning(f"{provider_name} rate limited (attempt {attempt}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    waited += delay
+                    continue
+                logger.error(f"Error calling {provider_name}: {e}")
+                return {
+                    'success': False,
+                    'error': str(e),
+                    'content': None,
+                    'tokens_prompt': 0,
+                    'tokens_completion': 0
+                }
+    
+    async def _call_ai_provider_cached(self, provider_info: Dict[str, Any], formatted_prompt: str, question: str,
+                                       retry_rate_limits: bool = False) -> Tuple[Dict[str, Any], Optional[str], Any]:
+        # Also returns the cache key and embedding for _finalize_response, which
+        # stores the reply only once it has parsed and passed mask_output.
+        cached, key, embedding = await self._cache_lookup(provider_info, formatted_prompt, question)
+        if cached is not None:
+            return cached, None, None
+        
+        return await self._call_ai_provider(provider_info, formatted_prompt, retry_rate_limits), key, embedding
+    
+    async def _cache_lookup(self, provider_info: Dict[str, Any], formatted_prompt: str,
+                            question: str) -> Tuple[Optional[Dict[str, Any]], Optional[str], Any]:
+        key = None
+        if self.response_cache.enabled:
+            key = ResponseCache.make_key(provider_info.get('provider'), provider_info.get('model'), question,
+                                         self._prompt_id)
+            content = self.response_cache.get(key)
+            if content is not None:
+                return self._cached_result(content), key, None
+        
+        embedding = None
+        if self.semantic_cache:
+            # Embedding is CPU-bound; keep it off the event loop.
+            embedding = await asyncio.to_thread(self.semantic_cache.encode, question)
+            content = self.semantic_cache.get(embedding)
+            if content is not None:
+                return self._cached_result(content), key, embedding
+        
+        return None, key, embedding
+    
+    def _cache_store(self, key: Optional[str], embedding: Any, content: str):
+        # Only the redacted output is cached (and persisted). mask_output
+        # gives the same result on it, since redaction is idempotent.
+        if self.safety_checker:
+            content = self.safety_checker.redact_pii(content)
+        if key is not None:
+            self.response_cache.put(key, content)
+        if embedding is not None:
+            self.semantic_cache.put(embedding, content)
+    
+    def _cached_result(self, content: str) -> Dict[str, Any]:
+        return {
+            'success': True,
+            'content': content,
+            'tokens_prompt': 0,
+            'tokens_completion': 0,
+            'cache_hit': True
+        }
+    
+    async def _stream_ai_provider(self, provider_info: Dict[str, Any], formatted_prompt: str,
+                                  usage: Dict[str, int]) -> AsyncIterator[str]:
+        # Yields text deltas; token usage reported by the provider is written into `usage`.
+        provider_name = provider_info.get('provider')
+        client = provider_info.get('client')
+        temperature = provider_info.get('temperature', 0.3)
+        
+        if provider_name in ("openai", "openrouter"):
+            stream = await client.chat.completions.create(
+                model=provider_info.get('model'),
+                messages=[
+                    _SYSTEM_MESSAGE,
+                    {"role": "user", "content": formatted_prompt}
+                ],
+                temperature=temperature,
+                max_tokens=500,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            async for chunk in stream:
+                if chunk.usage:
+                    usage['tokens_prompt'] = chunk.usage.prompt_tokens
+                    usage['tokens_completion'] = chunk.usage.completion_tokens
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        elif provider_name == "gemini":
+            response = await client.generate_content_async(
+                formatted_prompt,
+                generation_config={
+                    'temperature': temperature,
+                    'max_output_tokens': 500
+                },
+                request_options={'timeout': self.provider_timeout},
+                stream=True
+            )
+            async for chunk in response:
+                if chunk.parts:
+                    yield chunk.text
+        else:
+            raise ValueError(f'Unknown provider: {provider_name}')
     
-    def _call_openai(self, client: Any, model: str, formatted_prompt: str) -> Dict[str, Any]:
-        temperature = float(os.getenv('OPENAI_TEMPERATURE', '0.3'))
-        response = client.chat.completions.create(
+    async def _call_openai(self, client: Any, model: str, formatted_prompt: str, temperature: float) -> Dict[str, Any]:
+        response = await client.chat.completions.create(
             model=model,
             messages=[
-                {"role": "system", "content": "You are a helpful assistant that responds only with valid JSON."},
+                _SYSTEM_MESSAGE,
                 {"role": "user", "content": formatted_prompt}
             ],
             temperature=temperature,
@@ -288,27 +759,22 @@ Response Format:
             'tokens_completion': usage.completion_tokens
         }
     
-    def _call_gemini(self, client: Any, formatted_prompt: str) -> Dict[str, Any]:
-        temperature = float(os.getenv('GEMINI_TEMPERATURE', '0.3'))
-        response = client.generate_content(
+    async def _call_gemini(self, client: Any, formatted_prompt: str, temperature: float) -> Dict[str, Any]:
+        response = await client.generate_content_async(
             formatted_prompt,
             generation_config={
                 'temperature': temperature,
                 'max_output_tokens': 500
-            }
+            },
+            request_options={'timeout': self.provider_timeout}
         )
         
-        content = response.text.strip()
-        if content.startswith('```json'):
-            content = content[7:]
-        if content.startswith('```'):
-            content = content[3:]
-        if content.endswith('```'):
-            content = content[:-3]
-        content = content.strip()
+        content = _strip_code_fences(response.text)
         
-        tokens_prompt = max(1, len(formatted_prompt) // 3.5)
-        tokens_completion = max(1, len(content) // 3.5)
+        # Gemini reports real counts in usage_metadata; estimate only if missing.
+        usage = getattr(response, 'usage_metadata', None)
+        tokens_prompt = getattr(usage, 'prompt_token_count', 0) or _count_tokens(formatted_prompt)
+        tokens_completion = getattr(usage, 'candidates_token_count', 0) or _count_tokens(content)
         
         return {
             'success': True,
@@ -317,30 +783,22 @@ Response Format:
             'tokens_completion': tokens_completion
         }
     
-    def _call_openrouter(self, client: Any, model: str, formatted_prompt: str) -> Dict[str, Any]:
-        temperature = float(os.getenv('OPENROUTER_TEMPERATURE', '0.3'))
-        response = client.chat.completions.create(
+    async def _call_openrouter(self, client: Any, model: str, formatted_prompt: str, temperature: float) -> Dict[str, Any]:
+        response = await client.chat.completions.create(
             model=model,
             messages=[
-                {"role": "system", "content": "You are a helpful assistant that responds only with valid JSON."},
+                _SYSTEM_MESSAGE,
                 {"role": "user", "content": formatted_prompt}
             ],
             temperature=temperature,
             max_tokens=500
         )
         
-        content = response.choices[0].message.content.strip()
-        if content.startswith('```json'):
-            content = content[7:]
-        if content.startswith('```'):
-            content = content[3:]
-        if content.endswith('```'):
-            content = content[:-3]
-        content = content.strip()
+        content = _strip_code_fences(response.choices[0].message.content)
         
         usage = response.usage
-        tokens_prompt = usage.prompt_tokens if usage else max(1, len(formatted_prompt) // 3.5)
-        tokens_completion = usage.completion_tokens if usage else max(1, len(content) // 3.5)
+        tokens_prompt = usage.prompt_tokens if usage else _count_tokens(formatted_prompt)
+        tokens_completion = usage.completion_tokens if usage else _count_tokens(content)
         
         return {
             'success': True,
@@ -350,6 +808,153 @@ Response Format:
         }
     
     def process_query(self, question: str) -> Dict[str, Any]:
+        # Synchronous entry point for the CLI and scripts. A single private
+        # event loop is reused so the async HTTP clients keep their pools.
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError("process_query() cannot be called from a running event loop; "
+                               "use 'await aprocess_query()' instead")
+        if self._loop is None or self._loop.is_closed():
+            self._loop = _new_event_loop()
+        return self._loop.run_until_complete(self.aprocess_query(question))
+    
+    async def aprocess_query(self, question: str, retry_rate_limits: bool = False) -> Dict[str, Any]:
+        # retry_rate_limits backs off and retries on HTTP 429 before falling back;
+        # aprocess_queries sets it, single requests go straight to fallback.
+        early_response, provider_info, sanitized_question, formatted_prompt = self._prepare_query(question)
+        if early_response is not None:
+            return early_response
+        
+        start_ns = time.perf_counter_ns()
+        api_result, cache_key, embedding = await self._call_ai_provider_cached(provider_info, formatted_prompt,
+                                                                               sanitized_question, retry_rate_limits)
+        latency_ms = (time.perf_counter_ns() - start_ns) / 1e6
+        
+        if not api_result['success']:
+            logger.warning(f"Primary provider failed: {api_result['error']}, trying fallback...")
+            fallback_info = await asyncio.to_thread(self._try_fallback_provider)
+            if fallback_info:
+                start_ns = time.perf_counter_ns()
+                api_result, cache_key, embedding = await self._call_ai_provider_cached(
+                    fallback_info, formatted_prompt, sanitized_question, retry_rate_limits)
+                latency_ms = (time.perf_counter_ns() - start_ns) / 1e6
+                provider_info = fallback_info
+        
+        if not api_result['success']:
+            return self._error_response(api_result['error'], latency_ms)
+        
+        return self._finalize_response(question, provider_info, api_result, latency_ms, cache_key, embedding)
+    
+    def _shared_semaphore(self) -> asyncio.Semaphore:
+        # One semaphore per event loop, shared by every aprocess_queries call,
+        # so TEXTUTIL_MAX_CONCURRENCY caps provider calls across concurrent batches.
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+    
+    async def aprocess_queries(self, questions: list, concurrency: Optional[int] = None) -> list:
+        # Fans out over the questions with at most TEXTUTIL_MAX_CONCURRENCY provider
+        # calls in flight overall (or `concurrency` for this call alone, if given).
+        # Results keep the input order; an unexpected exception is returned in
+        # place of that question's response rather than raised.
+        semaphore = asyncio.Semaphore(concurrency) if concurrency else self._shared_semaphore()
+        
+        async def _one(question: str) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.aprocess_query(question, retry_rate_limits=True)
+        
+        return await asyncio.gather(*(_one(q) for q in questions), return_exceptions=True)
+    
+    async def astream_query(self, question: str) -> AsyncIterator[Tuple[str, Any]]:
+        # Yields ('delta', text) events while the provider is generating, then a
+        # single ('result', response) event shaped exactly like aprocess_query().
+        # Deltas are released a line at a time after PII redaction and stop as
+        # soon as a line trips the harmful-output check; the result is authoritative.
+        early_response, provider_info, sanitized_question, formatted_prompt = self._prepare_query(question)
+        if early_response is not None:
+            yield 'result', early_response
+            return
+        
+        start_ns = time.perf_counter_ns()
+        cached, cache_key, embedding = await self._cache_lookup(provider_info, formatted_prompt, sanitized_question)
+        if cached is not None:
+            latency_ms = (time.perf_counter_ns() - start_ns) / 1e6
+            yield 'result', self._finalize_response(question, provider_info, cached, latency_ms)
+            return
+        
+        first_token_ms = None
+        emitted = False
+        fell_back = False
+        while True:
+            usage: Dict[str, int] = {}
+            chunks = []
+            pending = ''
+            suppressed = False
+            try:
+                async for delta in self._stream_ai_provider(provider_info, formatted_prompt, usage):
+                    if first_token_ms is None:
+                        first_token_ms = (time.perf_counter_ns() - start_ns) / 1e6
+                    chunks.append(delta)
+                    if suppressed:
+                        continue
+                    pending += delta
+                    while '\n' in pending:
+                        line, pending = pending.split('\n', 1)
+                        released = self._release_stream_text(line + '\n')
+                        if released is None:
+                            suppressed = True
+                            break
+                        emitted = True
+                        yield 'delta', released
+                if pending and not suppressed:
+                    released = self._release_stream_text(pending)
+                    if released is not None:
+                        emitted = True
+                        yield 'delta', released
+                content = _strip_code_fences(''.join(chunks))
+                api_result = {
+                    'success': True,
+                    'content': content,
+                    'tokens_prompt': usage.get('tokens_prompt') or _count_tokens(formatted_prompt),
+                    'tokens_completion': usage.get('tokens_completion') or _count_tokens(content)
+                }
+                break
+            except Exception as e:
+                logger.error(f"Error streaming from {provider_info.get('provider')}: {e}")
+                api_result = {'success': False, 'error': str(e)}
+                if emitted or fell_back:
+                    break
+                logger.warning(f"Primary provider failed: {e}, trying fallback...")
+                fallback_info = await asyncio.to_thread(self._try_fallback_provider)
+                if not fallback_info:
+                    break
+                provider_info = fallback_info
+                fell_back = True
+        
+        latency_ms = (time.perf_counter_ns() - start_ns) / 1e6
+        if not api_result['success']:
+            yield 'result', self._error_response(api_result['error'], latency_ms)
+            return
+        
+        response = self._finalize_response(question, provider_info, api_result, latency_ms, cache_key, embedding)
+        if first_token_ms is not None:
+            response['metrics']['time_to_first_token_ms'] = round(first_token_ms, 2)
+        yield 'result', response
+    
+    def _release_stream_text(self, text: str) -> Optional[str]:
+        if not self.safety_checker:
+            return text
+        if not self.safety_checker.check_response(text)['safe']:
+            logger.warning("Stopped streaming deltas: harmful content detected in partial output")
+            return None
+        return self.safety_checker.redact_pii(text)
+    
+    def _prepare_query(self, question: str) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]], str, str]:
         logger.info(f"Processing query: {question[:50]}...")
         safety_result = self._safety_check(question)
         if not safety_result['safe']:
@@ -368,7 +973,7 @@ Response Format:
                     'latency_ms': 0,
                     'estimated_cost_usd': 0.0
                 }
-            }
+            }, None, question, ''
         
         provider_info = self._get_current_provider()
         if not provider_info:
@@ -386,56 +991,49 @@ Response Format:
                     'latency_ms': 0,
                     'estimated_cost_usd': 0.0
                 }
-            }
+            }, None, question, ''
         
         sanitized_question = question
         if self.safety_checker:
             sanitized_question = self.safety_checker.sanitize_user_input(question)
         
-        formatted_prompt = self.prompt_template.format(question=sanitized_question)
-        start_time = time.perf_counter()
-        api_result = self._call_ai_provider(provider_info, formatted_prompt)
-        end_time = time.perf_counter()
-        latency_ms = (end_time - start_time) * 1000
-        
-        if not api_result['success']:
-            logger.warning(f"Primary provider failed: {api_result['error']}, trying fallback...")
-            fallback_info = self._try_fallback_provider()
-            if fallback_info:
-                start_time = time.perf_counter()
-                api_result = self._call_ai_provider(fallback_info, formatted_prompt)
-                end_time = time.perf_counter()
-                latency_ms = (end_time - start_time) * 1000
-                provider_info = fallback_info
-        
-        if not api_result['success']:
-            logger.error(f"API call failed: {api_result['error']}")
-            return {
-                'answer': f'Error processing request: {api_result["error"]}',
-                'confidence': 0.0,
-                'actions': ['Please try again later'],
-                'category': 'other',
-                'follow_up': None,
-                'error': api_result['error'],
-                'metrics': {
-                    'tokens_prompt': 0,
-                    'tokens_completion': 0,
-                    'total_tokens': 0,
-                    'latency_ms': latency_ms,
-                    'estimated_cost_usd': 0.0
-                }
+        return None, provider_info, sanitized_question, self._format_prompt(sanitized_question)
+    
+    def _error_response(self, error: str, latency_ms: float) -> Dict[str, Any]:
+        logger.error(f"API call failed: {error}")
+        return {
+            'answer': f'Error processing request: {error}',
+            'confidence': 0.0,
+            'actions': ['Please try again later'],
+            'category': 'other',
+            'follow_up': None,
+            'error': error,
+            'metrics': {
+                'tokens_prompt': 0,
+                'tokens_completion': 0,
+                'total_tokens': 0,
+                'latency_ms': round(latency_ms, 2),
+                'estimated_cost_usd': 0.0
             }
-        
+        }
+    
+    def _finalize_response(self, question: str, provider_info: Dict[str, Any], api_result: Dict[str, Any],
+                           latency_ms: float, cache_key: Optional[str] = None,
+                           embedding: Any = None) -> Dict[str, Any]:
         output_content = api_result['content']
+        provider_name = provider_info.get('provider', 'unknown')
+        model_name = provider_info.get('model', 'unknown')
+        # Computed once and shared with the metrics row.
+        estimated_cost = self._calculate_cost(provider_name, api_result['tokens_prompt'], api_result['tokens_completion'])
+        safety_passed = True
         
         if self.safety_checker:
             mask_result = self.safety_checker.mask_output(output_content)
             if mask_result['action'] == 'block':
                 logger.warning(f"Output blocked due to invalid response: {mask_result.get('reason', '')}")
-                provider_name = provider_info.get('provider', 'unknown')
-                model_name = provider_info.get('model', 'unknown')
                 self._log_metrics(question, provider_name, api_result['tokens_prompt'], 
-                                 api_result['tokens_completion'], latency_ms, False, model_name, output_content)
+                                 api_result['tokens_completion'], latency_ms, False, model_name, mask_result['text'],
+                                 estimated_cost, output_redacted=True)
                 return {
                     'answer': 'I cannot process this request',
                     'confidence': 1.0,
@@ -447,21 +1045,30 @@ Response Format:
                         'tokens_prompt': api_result['tokens_prompt'],
                         'tokens_completion': api_result['tokens_completion'],
                         'total_tokens': api_result['tokens_prompt'] + api_result['tokens_completion'],
-                        'latency_ms': latency_ms,
-                        'estimated_cost_usd': round(self._calculate_cost(provider_name, api_result['tokens_prompt'], 
-                                                                        api_result['tokens_completion']), 6),
+                        'latency_ms': round(latency_ms, 2),
+                        'estimated_cost_usd': round(estimated_cost, 6),
                         'provider': provider_name,
-                        'model': model_name
+                        'model': model_name,
+                        'cache_hit': api_result.get('cache_hit', False)
                     }
                 }
             if mask_result['action'] == 'allow-masked':
                 output_content = mask_result['text']
                 logger.warning(f"Output masked due to PII detection: {mask_result['severity']}")
+            # mask_output has already run the invalid-response checks on this text.
+            safety_passed = mask_result['valid']
         
-        try:
-            json_response = json.loads(output_content)
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse JSON response: {e}")
+        # Anything that doesn't open with '{' can't be the expected object, so
+        # skip the parser (this also keeps arrays/scalars out of json_response).
+        json_response = None
+        if output_content.lstrip().startswith('{'):
+            try:
+                json_response = orjson.loads(output_content)
+            except orjson.JSONDecodeError as e:
+                logger.error(f"Failed to parse JSON response: {e}")
+        else:
+            logger.error("Failed to parse JSON response: not a JSON object")
+        if json_response is None:
             json_response = {
                 'answer': 'Error parsing response',
                 'confidence': 0.0,
@@ -469,55 +1076,92 @@ Response Format:
                 'category': 'other',
                 'follow_up': None
             }
-        
-        provider_name = provider_info.get('provider', 'unknown')
-        model_name = provider_info.get('model', 'unknown')
-        
-        safety_passed = True
-        if self.safety_checker:
-            response_check = self.safety_checker._check_invalid_response_patterns(output_content)
-            safety_passed = response_check['valid']
+        else:
+            # Only replies that parsed and were not blocked are cached, so a bad
+            # reply is retried on the next request instead of served from cache.
+            self._cache_store(cache_key, embedding, output_content)
         
         self._log_metrics(question, provider_name, api_result['tokens_prompt'], 
-                         api_result['tokens_completion'], latency_ms, safety_passed, model_name, output_content)
+                         api_result['tokens_completion'], latency_ms, safety_passed, model_name, output_content,
+                         estimated_cost, output_redacted=self.safety_checker is not None)
         
         json_response['metrics'] = {
             'tokens_prompt': api_result['tokens_prompt'],
             'tokens_completion': api_result['tokens_completion'],
             'total_tokens': api_result['tokens_prompt'] + api_result['tokens_completion'],
             'latency_ms': round(latency_ms, 2),
-            'estimated_cost_usd': round(self._calculate_cost(provider_name, api_result['tokens_prompt'], 
-                                                            api_result['tokens_completion']), 6),
+            'estimated_cost_usd': round(estimated_cost, 6),
             'provider': provider_name,
-            'model': model_name
+            'model': model_name,
+            'cache_hit': api_result.get('cache_hit', False)
         }
         
         logger.info(f"Query processed with {provider_name} ({model_name}). Tokens: {api_result['tokens_prompt'] + api_result['tokens_completion']}, Latency: {latency_ms:.2f}ms")
         return json_response
 
-def main():
-    utility = TextUtility()
+def _print_result(result: Dict[str, Any]):
+    print("\nResponse:")
+    print(orjson.dumps(result, option=orjson.OPT_INDENT_2).decode())
+    
+    if 'metrics' in result:
+        metrics = result['metrics']
+        print(f"\nMetrics:")
+        print(f"  Provider: {metrics.get('provider', 'unknown')}")
+        print(f"  Tokens: {metrics['total_tokens']} (prompt: {metrics['tokens_prompt']}, completion: {metrics['tokens_completion']})")
+        print(f"  Latency: {metrics['latency_ms']}ms")
+        print(f"  Estimated Cost: ${metrics['estimated_cost_usd']:.4f}")
+
+def _read_stdin_lines(loop: asyncio.AbstractEventLoop, lines: asyncio.Queue):
+    # Runs on a daemon thread. Reads the raw descriptor rather than
+    # sys.stdin, whose buffer lock a blocked read would still hold at
+    # interpreter exit (e.g. after Ctrl-C). None marks end of input.
+    encoding = sys.stdin.encoding or 'utf-8'
+    buffer = b''
     
-    if len(sys.argv) >= 2:
-        question = " ".join(sys.argv[1:])
-        result = utility.process_query(question)
-        print("\nResponse:")
-        print(json.dumps(result, indent=2))
-        
-        if 'metrics' in result:
-            metrics = result['metrics']
-            print(f"\nMetrics:")
-            print(f"  Provider: {metrics.get('provider', 'unknown')}")
-            print(f"  Tokens: {metrics['total_tokens']} (prompt: {metrics['tokens_prompt']}, completion: {metrics['tokens_completion']})")
-            print(f"  Latency: {metrics['latency_ms']}ms")
-            print(f"  Estimated Cost: ${metrics['estimated_cost_usd']:.4f}")
-    else:
+    def deliver(line: Optional[str]):
+        try:
+            loop.call_soon_threadsafe(lines.put_nowait, line)
+        except RuntimeError:
+            pass  # loop already closed
+    
+    while True:
+        try:
+            chunk = os.read(sys.stdin.fileno(), 4096)
+        except OSError:
+            chunk = b''
+        if not chunk:
+            if buffer:
+                deliver(buffer.decode(encoding, errors='replace'))
+            deliver(None)
+            return
+        buffer += chunk
+        while b'\n' in buffer:
+            line, buffer = buffer.split(b'\n', 1)
+            deliver(line.decode(encoding, errors='replace'))
+
+async def amain():
+    utility = TextUtility()
+    try:
+        if len(sys.argv) >= 2:
+            question = " ".join(sys.argv[1:])
+            _print_result(await utility.aprocess_query(question))
+            return
+        
         print("Multi-Task Text Utility")
         print("Type 'quit' to exit")
         print("-" * 40)
         
+        # stdin is read on a daemon thread so the event loop stays free while
+        # waiting for the user.
+        lines: asyncio.Queue = asyncio.Queue()
+        threading.Thread(target=_read_stdin_lines, args=(asyncio.get_running_loop(), lines),
+                         daemon=True).start()
         while True:
-            question = input("\nEnter your question: ").strip()
+            print("\nEnter your question: ", end="", flush=True)
+            line = await lines.get()
+            if line is None:
+                break
+            question = line.strip()
             
             if question.lower() in ['quit', 'exit', 'q']:
                 break
@@ -525,17 +1169,27 @@ def main():
             if not question:
                 continue
             
-            result = utility.process_query(question)
-            print("\nResponse:")
-            print(json.dumps(result, indent=2))
-            
-            if 'metrics' in result:
-                metrics = result['metrics']
-                print(f"\nMetrics:")
-                print(f"  Provider: {metrics.get('provider', 'unknown')}")
-                print(f"  Tokens: {metrics['total_tokens']} (prompt: {metrics['tokens_prompt']}, completion: {metrics['tokens_completion']})")
-                print(f"  Latency: {metrics['latency_ms']}ms")
-                print(f"  Estimated Cost: ${metrics['estimated_cost_usd']:.4f}")
+            _print_result(await utility.aprocess_query(question))
+    finally:
+        await utility.aclose()
+
+def main():
+    loop = _new_event_loop()
+    task = loop.create_task(amain())
+    try:
+        loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        # Let amain close the HTTP pool before exiting.
+        if not task.done():
+            task.cancel()
+            try:
+                loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass
+        raise
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
 
 if __name__ == "__main__":
     main()
@@ -2,38 +2,235 @@ import re
 import logging
 import os
 import hashlib
-from typing import Dict, Any
+import threading
+from functools import lru_cache
+from typing import Dict, Any, Optional
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+try:
+    import re2
+except ImportError:
+    re2 = None
 
 logger = logging.getLogger(__name__)
 
+# Unkeyed 32-byte BLAKE2b state; copying it is cheaper than constructing a
+# new hasher with parameters for every hash.
+_BLAKE2B_PROTOTYPE = hashlib.blake2b(digest_size=32)
+
+# Patterns and keyword lists are module constants, compiled once at import
+# and shared by every SafetyChecker instance.
+HARMFUL_PATTERNS = (
+    r'\b(jailbreak|prompt injection|ignore instructions)\b',
+    r'\b(ignore previous|forget everything|system prompt)\b',
+    r'\b(act as|pretend to be|roleplay as)\b',
+    r'\b(hack|crack|exploit|bypass)\b',
+    r'\b(illegal|unlawful|harmful|dangerous)\b',
+    r'\b(suicide|self-harm|violence|threat)\b',
+    r'\b(personal information|private data|confidential)\b',
+    r'\b(phishing|scam|fraud|malware)\b'
+)
+# Every pattern is \b(...)\b, so their alternatives are flattened into one
+# alternation inside a single pair of word boundaries: one scan, one boundary
+# test per position.
+_HARMFUL_ALTERNATION = (
+    r'\b(?:' + '|'.join(pattern.removeprefix(r'\b(').removesuffix(r')\b') for pattern in HARMFUL_PATTERNS) + r')\b'
+)
+_HARMFUL_RE = re.compile(_HARMFUL_ALTERNATION, re.IGNORECASE)
+# Case-sensitive twin for text that is already lowercased; see _is_harmful.
+_HARMFUL_LOWER_RE = re.compile(_HARMFUL_ALTERNATION)
+
+INJECTION_KEYWORDS = (
+    'ignore', 'forget', 'override', 'bypass', 'jailbreak',
+    'system', 'admin', 'root', 'privilege', 'elevate',
+    'injection', 'payload', 'exploit', 'vulnerability'
+)
+INSTRUCTION_PHRASES = (
+    'you must', 'you should', 'you will', 'act as',
+    'pretend to', 'roleplay as', 'developer mode',
+    'admin access', 'system prompt'
+)
+ADVERSARIAL_PATTERNS = (
+    'ignore previous', 'forget everything', 'override',
+    'bypass', 'jailbreak', 'unrestricted', 'developer mode'
+)
+_INJECTION_KEYWORD_SET = frozenset(INJECTION_KEYWORDS)
+_INSTRUCTION_PHRASE_SET = frozenset(INSTRUCTION_PHRASES)
+_ADVERSARIAL_PATTERN_SET = frozenset(ADVERSARIAL_PATTERNS)
+# Each distinct token once: bypass, jailbreak, override and developer mode
+# appear in two lists but only need to be searched for once.
+_INJECTION_TOKENS = tuple(dict.fromkeys(INJECTION_KEYWORDS + INSTRUCTION_PHRASES + ADVERSARIAL_PATTERNS))
+
+# Prohibited in responses as plain substrings, on top of the harmful patterns.
+RESPONSE_HARMFUL_KEYWORDS = (
+    'jailbreak', 'system prompt', 'ignore instructions',
+    'bypass security', 'exploit', 'hack', 'crack'
+)
+
+def _build_hyperscan_database(expressions):
+    # With the optional hyperscan package, lowercased ASCII text is scanned
+    # by its SIMD engine instead of the regex VM. \b means the same on ASCII
+    # input in both, so the result is identical. Expression i reports id i.
+    if hyperscan is None:
+        return None
+    try:
+        database = hyperscan.Database()
+        database.compile(expressions=[expression.encode('ascii') for expression in expressions],
+                         ids=list(range(len(expressions))),
+                         flags=[hyperscan.HS_FLAG_SINGLEMATCH] * len(expressions))
+    except Exception as e:
+        logger.warning(f"hyperscan unavailable, using re for harmful patterns: {e}")
+        return None
+    return database
+
+# Questions need only the harmful alternation (id 0). Responses also check
+# the prohibited keywords (id i + 1 for keyword i), so both come out of a
+# single scan.
+_HARMFUL_DATABASE = _build_hyperscan_database([_HARMFUL_ALTERNATION])
+_RESPONSE_DATABASE = _build_hyperscan_database(
+    [_HARMFUL_ALTERNATION] + [re.escape(keyword) for keyword in RESPONSE_HARMFUL_KEYWORDS]
+)
+# hyperscan scratch space must not be shared between concurrent scans.
+_scan_local = threading.local()
+
+def _collect_match(match_id, start, end, flags, matched) -> bool:
+    matched.add(match_id)
+    # A harmful-pattern match settles the result; stop scanning.
+    return match_id == 0
+
+def _hyperscan_matches(database, text_lower: str) -> set:
+    scratches = getattr(_scan_local, 'scratches', None)
+    if scratches is None:
+        scratches = _scan_local.scratches = {}
+    scratch = scratches.get(id(database))
+    if scratch is None:
+        scratch = scratches[id(database)] = hyperscan.Scratch(database)
+    matched = set()
+    try:
+        database.scan(text_lower.encode('ascii'), match_event_handler=_collect_match,
+                      context=matched, scratch=scratch)
+    except hyperscan.ScanTerminated:
+        pass
+    return matched
+
+def _is_harmful(text: str, text_lower: str) -> bool:
+    # Lowercased ASCII can be matched without IGNORECASE, which is several
+    # times faster. Other text keeps IGNORECASE so Unicode case folding
+    # (e.g. long s, dotted I) still matches as before.
+    if text.isascii():
+        if _HARMFUL_DATABASE is not None:
+            return 0 in _hyperscan_matches(_HARMFUL_DATABASE, text_lower)
+        return _HARMFUL_LOWER_RE.search(text_lower) is not None
+    return _HARMFUL_RE.search(text) is not None
+
+def _build_keyword_automaton():
+    # With the optional pyahocorasick package, all three injection keyword
+    # lists are matched in a single pass over the question.
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for keyword in _INJECTION_TOKENS:
+        automaton.add_word(keyword, keyword)
+    automaton.make_automaton()
+    return automaton
+
+_KEYWORD_AUTOMATON = _build_keyword_automaton()
+
+# Each control phrase is paired with the fixed word it starts with, so its
+# substitution can be skipped when that word is absent.
+_CONTROL_PHRASES = tuple((re.match(r'\w+', pattern).group().lower(), re.compile(pattern, re.IGNORECASE)) for pattern in (
+    r'ignore\s+(all\s+)?(previous\s+)?(your\s+)?instructions?',
+    r'ignore\s+all\s+previous',
+    r'forget\s+(everything|all)\s+(I\s+said|previous)',
+    r'reveal\s+(system|hidden|your)\s+prompt',
+    r'from\s+now\s+on\s+obey\s+me',
+    r'developer\s+mode',
+    r'jailbreak',
+    r'act\s+as\s+.*?admin'
+))
+
+_EMAIL_RE = re.compile(r'\b[\w\.-]+@[\w\.-]+\.\w{2,}\b')
+_PHONE_RE = re.compile(r'\b\+?\d[\d\-\s]{7,}\d\b')
+_ACCOUNT_RE = re.compile(r'\b\d{2,4}[-\s]?\d{3,}[-\s]?\d{2,}\b')
+_SECRETS_RE = re.compile(r'(api[_-]?key|secret|token|password|ssn)\s*[:=]\s*\S+', re.IGNORECASE)
+_DIGIT_RE = re.compile(r'\d')
+
+def _build_re2_pii_patterns():
+    # With the optional google-re2 package, ASCII text is redacted by a
+    # linear-time engine; the email pattern backtracks quadratically in re
+    # on long crafted inputs. re2's \s lacks \v and \x1c-\x1f, so Python's
+    # ASCII whitespace is spelled out.
+    if re2 is None:
+        return None
+    ws = r'\t\n\x0b\x0c\r\x1c-\x1f '
+    return (
+        re2.compile(_EMAIL_RE.pattern),
+        re2.compile(r'\b\+?\d[\d\-' + ws + r']{7,}\d\b'),
+        re2.compile(r'\b\d{2,4}[-' + ws + r']?\d{3,}[-' + ws + r']?\d{2,}\b'),
+        re2.compile(r'(?i)(api[_-]?key|secret|token|password|ssn)[' + ws + r']*[:=][' + ws + r']*[^' + ws + r']+')
+    )
+
+_RE2_PII_PATTERNS = _build_re2_pii_patterns()
+
+_CODE_FENCE_RE = re.compile(r'```(.*?)```', re.DOTALL)
+
+_ONLY_NUMERIC_RE = re.compile(r'^[\d\s\-\.]+$')
+_ONLY_ASTERISKS_RE = re.compile(r'^[*]+$')
+_ONLY_SPECIAL_RE = re.compile(r'^[^a-zA-Z0-9\s]+$')
+_NON_ALNUM_RE = re.compile(r'[^a-zA-Z0-9]')
+
+def _has_few_distinct(text: str, limit: int = 2) -> bool:
+    # True when text has at most `limit` distinct non-space characters.
+    # Ordinary text shows a third one within its first few characters, so
+    # the head is walked with an early exit and only a repetitive head
+    # falls through to the full set.
+    seen = set()
+    for char in text[:32]:
+        if char != ' ':
+            seen.add(char)
+            if len(seen) > limit:
+                return False
+    return len(set(text.replace(' ', ''))) <= limit
+
 class SafetyChecker:
     def __init__(self):
-        self.harmful_patterns = [
-            r'\b(jailbreak|prompt injection|ignore instructions)\b',
-            r'\b(ignore previous|forget everything|system prompt)\b',
-            r'\b(act as|pretend to be|roleplay as)\b',
-            r'\b(hack|crack|exploit|bypass)\b',
-            r'\b(illegal|unlawful|harmful|dangerous)\b',
-            r'\b(suicide|self-harm|violence|threat)\b',
-            r'\b(personal information|private data|confidential)\b',
-            r'\b(phishing|scam|fraud|malware)\b'
-        ]
-        self.compiled_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in self.harmful_patterns]
-        self.injection_keywords = [
-            'ignore', 'forget', 'override', 'bypass', 'jailbreak',
-            'system', 'admin', 'root', 'privilege', 'elevate',
-            'injection', 'payload', 'exploit', 'vulnerability'
-        ]
+        self.harmful_patterns = HARMFUL_PATTERNS
+        self.injection_keywords = INJECTION_KEYWORDS
         self.max_question_length = 2000
         self.min_question_length = 3
         
-        self.email_pattern = re.compile(r'\b[\w\.-]+@[\w\.-]+\.\w{2,}\b')
-        self.phone_pattern = re.compile(r'\b\+?\d[\d\-\s]{7,}\d\b')
-        self.account_pattern = re.compile(r'\b\d{2,4}[-\s]?\d{3,}[-\s]?\d{2,}\b')
-        self.secrets_pattern = re.compile(r'(api[_-]?key|secret|token|password|ssn)\s*[:=]\s*\S+', re.IGNORECASE)
-        self.code_fence_pattern = re.compile(r'```(.*?)```', re.DOTALL)
+        self.email_pattern = _EMAIL_RE
+        self.phone_pattern = _PHONE_RE
+        self.account_pattern = _ACCOUNT_RE
+        self.secrets_pattern = _SECRETS_RE
+        self.code_fence_pattern = _CODE_FENCE_RE
+        self.log_salt = os.getenv('LOG_SALT', 'static-salt')
+        
+        # The checks are pure functions of their input, so repeated prompts
+        # and outputs (retries, response-cache hits) are answered from
+        # per-instance LRU caches. SAFETY_CACHE_SIZE=0 disables them.
+        cache_size = int(os.getenv('SAFETY_CACHE_SIZE', '4096'))
+        self._check_safety_cached = lru_cache(maxsize=cache_size)(self._check_safety)
+        self._sanitize_cached = lru_cache(maxsize=cache_size)(self._sanitize_user_input)
+        self._redact_cached = lru_cache(maxsize=cache_size)(self._redact_pii)
+        self._hash_cached = lru_cache(maxsize=cache_size)(self._hash_content)
     
     def check_safety(self, question: str) -> Dict[str, Any]:
+        if not isinstance(question, str):
+            return self._check_safety(question)
+        # Copied so a caller modifying its result can't affect later hits.
+        return dict(self._check_safety_cached(question))
+    
+    def _check_safety(self, question: str) -> Dict[str, Any]:
         if not question or not isinstance(question, str):
             return {
                 'safe': False,
@@ -64,15 +261,15 @@ class SafetyChecker:
                 'confidence': 1.0
             }
         
-        for pattern in self.compiled_patterns:
-            if pattern.search(question_stripped):
-                return {
-                    'safe': False,
-                    'reason': f'Detected potentially harmful content',
-                    'confidence': 0.8
-                }
+        question_lower = question_stripped.lower()
+        if _is_harmful(question_stripped, question_lower):
+            return {
+                'safe': False,
+                'reason': f'Detected potentially harmful content',
+                'confidence': 0.8
+            }
         
-        injection_score = self._calculate_injection_score(question_stripped)
+        injection_score = self._calculate_injection_score(question_stripped, question_lower)
         if injection_score > 0.5:
             return {
                 'safe': False,
@@ -92,52 +289,50 @@ class SafetyChecker:
         
         stripped = question.strip()
         
-        if re.match(r'^[\d\s\-\.]+$', stripped):
+        if _ONLY_NUMERIC_RE.match(stripped):
             return {'valid': False, 'reason': 'Question contains only numbers or numeric characters'}
         
-        if re.match(r'^[*]+$', stripped):
+        if _ONLY_ASTERISKS_RE.match(stripped):
             return {'valid': False, 'reason': 'Question contains only asterisks or special characters'}
         
-        if re.match(r'^[^a-zA-Z0-9\s]+$', stripped):
+        if _ONLY_SPECIAL_RE.match(stripped):
             return {'valid': False, 'reason': 'Question contains only special characters'}
         
-        if len(set(stripped.replace(' ', ''))) <= 2 and len(stripped) >= 5:
+        if len(stripped) >= 5 and _has_few_distinct(stripped):
             return {'valid': False, 'reason': 'Question contains repetitive or meaningless characters'}
         
-        if len(re.sub(r'\s+', '', stripped)) < 3:
-            alphanumeric_only = re.sub(r'[^a-zA-Z0-9]', '', stripped)
+        # When the head alone has three non-whitespace characters the whole
+        # string does too. str.split() splits on the same characters as \s.
+        if len(''.join(stripped[:32].split())) < 3 and len(''.join(stripped.split())) < 3:
+            alphanumeric_only = _NON_ALNUM_RE.sub('', stripped)
             if len(alphanumeric_only) < 3:
                 return {'valid': False, 'reason': 'Question lacks meaningful content'}
         
         return {'valid': True, 'reason': 'Valid question format'}
     
-    def _calculate_injection_score(self, question: str) -> float:
+    def _calculate_injection_score(self, question: str, question_lower: Optional[str] = None) -> float:
         score = 0.0
-        question_lower = question.lower()
-        
-        keyword_count = sum(1 for keyword in self.injection_keywords if keyword in question_lower)
-        score += min(keyword_count * 0.2, 0.6)
-        
-        instruction_phrases = [
-            'you must', 'you should', 'you will', 'act as', 
-            'pretend to', 'roleplay as', 'developer mode', 
-            'admin access', 'system prompt'
-        ]
+        if question_lower is None:
+            question_lower = question.lower()
         
-        instruction_count = sum(1 for phrase in instruction_phrases if phrase in question_lower)
-        score += min(instruction_count * 0.25, 0.4)
+        if _KEYWORD_AUTOMATON is not None:
+            found = {keyword for _, keyword in _KEYWORD_AUTOMATON.iter(question_lower)}
+        else:
+            found = {token for token in _INJECTION_TOKENS if token in question_lower}
         
-        adversarial_patterns = [
-            'ignore previous', 'forget everything', 'override', 
-            'bypass', 'jailbreak', 'unrestricted', 'developer mode'
-        ]
-        
-        adversarial_count = sum(1 for pattern in adversarial_patterns if pattern in question_lower)
-        score += min(adversarial_count * 0.4, 0.5)
+        score += min(len(found & _INJECTION_KEYWORD_SET) * 0.2, 0.6)
+        score += min(len(found & _INSTRUCTION_PHRASE_SET) * 0.25, 0.4)
+        if score >= 1.0:
+            # Already at the cap; the adversarial list can't change the result.
+            return 1.0
+        score += min(len(found & _ADVERSARIAL_PATTERN_SET) * 0.4, 0.5)
         
         return min(score, 1.0)
     
     def sanitize_user_input(self, text: str) -> str:
+        return self._sanitize_cached(text)
+    
+    def _sanitize_user_input(self, text: str) -> str:
         if not text:
             return ""
         text = self._strip_control_phrases(text)
@@ -145,18 +340,12 @@ class SafetyChecker:
         return text.strip()
     
     def _strip_control_phrases(self, text: str) -> str:
-        control_phrases = [
-            r'ignore\s+(all\s+)?(previous\s+)?(your\s+)?instructions?',
-            r'ignore\s+all\s+previous',
-            r'forget\s+(everything|all)\s+(I\s+said|previous)',
-            r'reveal\s+(system|hidden|your)\s+prompt',
-            r'from\s+now\s+on\s+obey\s+me',
-            r'developer\s+mode',
-            r'jailbreak',
-            r'act\s+as\s+.*?admin'
-        ]
-        for pattern in control_phrases:
-            text = re.sub(pattern, '[blocked-control]', text, flags=re.IGNORECASE)
+        # Only ASCII text can be pre-checked against the lowercased words;
+        # IGNORECASE also folds some non-ASCII characters onto ASCII letters.
+        text_lower = text.lower() if text.isascii() else None
+        for word, pattern in _CONTROL_PHRASES:
+            if text_lower is None or word in text_lower:
+                text = pattern.sub('[blocked-control]', text)
         return text
     
     def _literalize_code_blocks(self, text: str) -> str:
@@ -166,12 +355,25 @@ class SafetyChecker:
         return self.code_fence_pattern.sub(wrap, text)
     
     def redact_pii(self, text: str) -> str:
+        return self._redact_cached(text)
+    
+    def _redact_pii(self, text: str) -> str:
         if not text:
             return ""
-        text = self.email_pattern.sub('[redacted-email]', text)
-        text = self.phone_pattern.sub('[redacted-phone]', text)
-        text = self.account_pattern.sub('[redacted-account]', text)
-        text = self.secrets_pattern.sub('[redacted-secret]', text)
+        if _RE2_PII_PATTERNS is not None and text.isascii():
+            email, phone, account, secrets = _RE2_PII_PATTERNS
+        else:
+            email, phone, account, secrets = (self.email_pattern, self.phone_pattern,
+                                              self.account_pattern, self.secrets_pattern)
+        # Each pattern needs a character (an '@', a digit, a ':' or '=') that
+        # no placeholder contains, so patterns that cannot match are skipped.
+        if '@' in text:
+            text = email.sub('[redacted-email]', text)
+        if _DIGIT_RE.search(text):
+            text = phone.sub('[redacted-phone]', text)
+            text = account.sub('[redacted-account]', text)
+        if ':' in text or '=' in text:
+            text = secrets.sub('[redacted-secret]', text)
         return text
     
     def mask_output(self, text: str) -> Dict[str, Any]:
@@ -184,6 +386,7 @@ class SafetyChecker:
                 'action': 'block',
                 'text': safe,
                 'severity': 'high',
+                'valid': False,
                 'reason': invalid_response['reason']
             }
         
@@ -191,24 +394,32 @@ class SafetyChecker:
             return {
                 'action': 'allow-masked',
                 'text': safe,
-                'severity': 'medium'
+                'severity': 'medium',
+                'valid': True
             }
         return {
             'action': 'allow',
             'text': safe,
-            'severity': 'low'
+            'severity': 'low',
+            'valid': True
         }
     
+    def check_response(self, text: str) -> Dict[str, Any]:
+        # Harmful-content check on its own, for partial output that is still
+        # streaming and would fail mask_output's length and format checks.
+        return self._check_harmful_content_in_response(text)
+    
     def _check_invalid_response_patterns(self, response: str) -> Dict[str, Any]:
-        if not response or len(response.strip()) < 10:
+        stripped = response.strip() if response else ''
+        if len(stripped) < 10:
             return {'valid': False, 'reason': 'Response too short or empty'}
         
-        stripped = response.strip()
-        
-        if re.match(r'^[\d\s\-\.]+$', stripped[:100]):
+        # endpos bounds the match to the first 100 characters without slicing;
+        # $ matches at endpos just as it would at the end of the slice.
+        if _ONLY_NUMERIC_RE.match(stripped, 0, 100):
             return {'valid': False, 'reason': 'Response contains only numbers'}
         
-        if re.match(r'^[*]+$', stripped[:100]):
+        if _ONLY_ASTERISKS_RE.match(stripped, 0, 100):
             return {'valid': False, 'reason': 'Response contains only special characters'}
         
         harmful_content = self._check_harmful_content_in_response(stripped)
@@ -218,32 +429,50 @@ class SafetyChecker:
         return {'valid': True, 'reason': 'Valid response format'}
     
     def _check_harmful_content_in_response(self, response: str) -> Dict[str, Any]:
-        for pattern in self.compiled_patterns:
-            if pattern.search(response):
-                return {
-                    'safe': False,
-                    'reason': 'Response contains potentially harmful content'
-                }
-        
-        harmful_keywords = [
-            'jailbreak', 'system prompt', 'ignore instructions',
-            'bypass security', 'exploit', 'hack', 'crack'
-        ]
         response_lower = response.lower()
-        for keyword in harmful_keywords:
-            if keyword in response_lower:
-                return {
-                    'safe': False,
-                    'reason': f'Response contains prohibited content: {keyword}'
-                }
+        if _RESPONSE_DATABASE is not None and response.isascii():
+            matched = _hyperscan_matches(_RESPONSE_DATABASE, response_lower)
+            harmful = 0 in matched
+        else:
+            matched = None
+            harmful = _is_harmful(response, response_lower)
+        if harmful:
+            return {
+                'safe': False,
+                'reason': 'Response contains potentially harmful content'
+            }
+        
+        if matched is not None:
+            # Hyperscan ids 1..n follow RESPONSE_HARMFUL_KEYWORDS order.
+            for index, keyword in enumerate(RESPONSE_HARMFUL_KEYWORDS, 1):
+                if index in matched:
+                    return {
+                        'safe': False,
+                        'reason': f'Response contains prohibited content: {keyword}'
+                    }
+        else:
+            for keyword in RESPONSE_HARMFUL_KEYWORDS:
+                if keyword in response_lower:
+                    return {
+                        'safe': False,
+                        'reason': f'Response contains prohibited content: {keyword}'
+                    }
         
         return {'safe': True, 'reason': 'Response appears safe'}
     
     def anonymize_id(self, identifier: str, salt: str = None) -> str:
         if not salt:
-            salt = os.getenv('LOG_SALT', 'static-salt')
+            salt = self.log_salt
         return hashlib.sha256((salt + str(identifier)).encode('utf-8')).hexdigest()
     
     def hash_content(self, content: str) -> str:
-        redacted = self.redact_pii(content)
-        return hashlib.sha256(redacted.encode('utf-8')).hexdigest()
\ No newline at end of file
+        return self._hash_cached(content)
+    
+    def _hash_content(self, content: str) -> str:
+        return self.hash_redacted(self.redact_pii(content))
+    
+    def hash_redacted(self, redacted: str) -> str:
+        # hash_content for text that has already been through redact_pii.
+        hasher = _BLAKE2B_PROTOTYPE.copy()
+        hasher.update(redacted.encode('utf-8'))
+        return hasher.hexdigest()
\ No newline at end of file